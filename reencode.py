@@ -14,11 +14,22 @@ import json
 import humansize
 import sqlite3
 import hashlib
+import mmap
+import fcntl
 import traceback
+import threading
+import contextlib
+import concurrent.futures
+import multiprocessing
 from os import path
 from dataclasses import dataclass
 from typing import Optional
 
+try:
+    import av
+except ImportError:
+    av = None
+
 class Log:
     cyan    = '\033[36m'
     magenta = '\033[35m'
@@ -28,13 +39,23 @@ class Log:
     reset   = '\033[0m'
     pidtag  = f"{cyan}[{os.getpid()}]{reset}"
     tracing = False
+    lock    = threading.Lock()
+
+    # Forked workers would otherwise keep their parent's pid in the tag
+    def update_pidtag():
+        Log.pidtag = f"{Log.cyan}[{os.getpid()}]{Log.reset}"
 
+    # Writes each line in a single call, so lines from parallel workers don't interleave
     def print(first, *args):
-        print(f"{Log.pidtag}{first}", *args, file=sys.stderr)
-        sys.stderr.flush()
+        line = " ".join(map(str, [f"{Log.pidtag}{first}", *args])) + "\n"
+        with Log.lock:
+            sys.stderr.write(line)
+            sys.stderr.flush()
 
     def traced(func):
         def wrapper(*args, **kwargs):
+            if not Log.tracing:
+                return func(*args, **kwargs)
             printed_args = ", ".join(map(repr, args))
             printed_kwargs = ", ".join(map(lambda i: f"{str(i[0])}={repr(i[1])}", kwargs.items()))
             printed_all_args = ", ".join([a for a in [printed_args, printed_kwargs] if len(a) != 0])
@@ -66,6 +87,44 @@ class Probe:
     @functools.cache
     @Log.traced
     def probe(file):
+        (video_codecs, audio_codecs, duration) = Probe.probe_streams(file)
+        Log.check(len(video_codecs) == 1, "No video stream")
+        Log.check(len(audio_codecs) <= 1, "More than 1 audio stream")
+        Log.check(duration is not None, "Bad format data")
+        video_codec = video_codecs[0]
+        audio_codec = audio_codecs[0] if len(audio_codecs) == 1 else None
+        return (video_codec, audio_codec, duration)
+
+    # Returns (video codecs, audio codecs, duration or None)
+    def probe_streams(file):
+        if av is not None:
+            try:
+                if (result := Probe.probe_av(file)) is not None:
+                    return result
+            except av.error.FFmpegError as e:
+                Log.trace(f"PyAV failed to probe file, falling back to ffprobe ({e})")
+        return Probe.probe_ffprobe(file)
+
+    # In-process probing, avoids spawning ffprobe.
+    # Returns None if PyAV can't tell, so ffprobe should be used instead.
+    @Log.traced
+    def probe_av(file):
+        with av.open(file, metadata_errors="ignore") as container:
+            streams = [s for s in container.streams if s.type in ("video", "audio")]
+            # PyAV leaves codec_context unset for streams it has no decoder for
+            if any(s.codec_context is None for s in streams):
+                Log.trace("PyAV has no decoder for a stream, falling back to ffprobe")
+                return None
+            # codec_context.name is the decoder (e.g. libdav1d), ffprobe reports the codec (av1)
+            video_codecs = [s.codec_context.codec.canonical_name for s in streams if s.type == "video"]
+            audio_codecs = [s.codec_context.codec.canonical_name for s in streams if s.type == "audio"]
+            duration = container.duration
+        if duration is not None:
+            duration = float(duration) / av.time_base
+        return (video_codecs, audio_codecs, duration)
+
+    @Log.traced
+    def probe_ffprobe(file):
         result = run([
             "ffprobe",
             "-loglevel", "error",
@@ -76,14 +135,10 @@ class Probe:
         data = json.loads(result)
         video_codecs = [s["codec_name"] for s in data["streams"] if s["codec_type"] == "video"]
         audio_codecs = [s["codec_name"] for s in data["streams"] if s["codec_type"] == "audio"]
-        Log.check(len(video_codecs) == 1, "No video stream")
-        Log.check(len(audio_codecs) <= 1, "More than 1 audio stream")
-        Log.check("format" in data, "Bad format data")
-        Log.check("duration" in data["format"], "Bad format data")
-        video_codec = video_codecs[0]
-        audio_codec = audio_codecs[0] if len(audio_codecs) == 1 else None
-        duration = float(data["format"]["duration"])
-        return (video_codec, audio_codec, duration)
+        duration = data.get("format", {}).get("duration")
+        if duration is not None:
+            duration = float(duration)
+        return (video_codecs, audio_codecs, duration)
 
     def codec(file):
         return Probe.probe(file)[0]
@@ -94,29 +149,69 @@ class Probe:
     def duration(file):
         return Probe.probe(file)[2]
 
-    def isvideo(file):
-        try:
-            Probe.probe(file)
-            return True
-        except Log.ErrorCalled:
-            return False
+    # Probes files concurrently to fill probe's cache.
+    # Returns the results for files that probed successfully.
+    def probe_many(files: list[str]):
+        def try_probe(f):
+            try:
+                return Probe.probe(f)
+            except (Log.ErrorCalled, subprocess.CalledProcessError):
+                Log.error("Failed to probe", f, exception=False)
+                return None
+            except Exception:
+                Log.error(f"Unexpected error while probing '{f}'", exception=False)
+                traceback.print_exc()
+                return None
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            results = executor.map(try_probe, files)
+            return {f: r for (f, r) in zip(files, results) if r is not None}
 
 @Log.traced
 def run(cmd_list):
     Log.info(shlex.join(cmd_list))
-    proc = subprocess.run(cmd_list, check=True, stdout=subprocess.PIPE)
-    result = proc.stdout.decode('utf-8')
-    return result
+    proc = subprocess.run(cmd_list, check=True, stdout=subprocess.PIPE, text=True, encoding="utf-8", errors="replace")
+    return proc.stdout
+
+FFMPEG_PREFIX = ("nice", "ffmpeg", "-n", "-nostdin", "-hide_banner")
 
 @Log.traced
 def ffmpeg(args: list[str]):
-    return run([
-        "nice",
-        "ffmpeg",
-        "-n",
-        "-nostdin",
-        "-hide_banner"
-    ] + args)
+    return run([*FFMPEG_PREFIX, *args])
+
+class Encoders:
+    # Hardware HEVC encoders, in order of preference
+    HARDWARE = ["hevc_nvenc", "hevc_qsv"]
+    NVENC_PRESETS = {"ultrafast": "p1", "superfast": "p1", "veryfast": "p2", "faster": "p3", "fast": "p4",
+                     "medium": "p5", "slow": "p6", "slower": "p7", "veryslow": "p7"}
+    QSV_PRESETS = {"ultrafast": "veryfast", "superfast": "veryfast"}
+
+    # Being built into ffmpeg doesn't mean the hardware is there, so each
+    # candidate has to get through a short test encode
+    @functools.cache
+    @Log.traced
+    def hardware():
+        listed = run(["ffmpeg", "-hide_banner", "-encoders"])
+        for encoder in Encoders.HARDWARE:
+            if f" {encoder} " not in listed:
+                continue
+            test = subprocess.run([
+                "ffmpeg", "-hide_banner", "-nostdin",
+                "-f", "lavfi", "-i", "nullsrc=s=256x256:d=0.1",
+                "-c:v", encoder, "-f", "null", "-"
+            ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            if test.returncode == 0:
+                Log.info(f"Using hardware encoder {encoder}")
+                return encoder
+        return None
+
+    def args(encoder: str, crf: int, preset: str, threads: Optional[int]):
+        if encoder == "hevc_nvenc":
+            return ["-c:v", encoder, "-preset", Encoders.NVENC_PRESETS[preset], "-rc", "vbr", "-cq", str(crf), "-b:v", "0"]
+        if encoder == "hevc_qsv":
+            return ["-c:v", encoder, "-preset", Encoders.QSV_PRESETS.get(preset, preset), "-global_quality", str(crf)]
+        x265_params = "log-level=error" + (threads and f":pools={threads}" or "")
+        return ["-c:v", encoder, "-crf", str(crf), "-preset", preset, "-x265-params", x265_params]
 
 def as_mp4(f: str, warn: bool = True):
     if f.lower().endswith("mp4"):
@@ -131,9 +226,7 @@ def as_mp4(f: str, warn: bool = True):
 def file_size(f: str):
     return os.stat(f).st_size
 
-def file_size_percent(f1: str, f2: str):
-    s1 = os.stat(f1).st_size
-    s2 = os.stat(f2).st_size
+def size_percent(s1: int, s2: int):
     pct = 100 * s1 / s2
     return round(pct, 1)
 
@@ -142,22 +235,72 @@ def files_on_same_fs(f1: str, f2: str):
     d2 = os.stat(f2).st_dev
     return d1 == d2
 
+# Hints the kernel about how a file will be accessed, where posix_fadvise is available
+def fadvise(fd: int, advice: str):
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(fd, 0, 0, getattr(os, advice))
+
+# Linux ioctl that makes dst share src's data blocks (btrfs, XFS, bcachefs)
+FICLONE = 0x40049409
+
+def reflink(fsrc, fdst):
+    try:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        return True
+    except OSError as e:
+        Log.trace(f"Reflink failed ({e})")
+        return False
+
+COPY_CHUNK = 1024 * 1024 * 1024
+
+def stream_copy(fsrc, fdst):
+    fadvise(fsrc.fileno(), "POSIX_FADV_SEQUENTIAL")
+    size = os.fstat(fsrc.fileno()).st_size
+    copied = 0
+    try:
+        # Copies inside the kernel, without passing the data through userspace
+        while copied < size:
+            n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), COPY_CHUNK)
+            if n == 0:
+                break
+            copied += n
+    except (AttributeError, OSError) as e:
+        Log.trace(f"copy_file_range failed ({e})")
+
+    # Unsupported platform or filesystem pair, or some kernels return 0 early for
+    # cross-fs copies instead of failing. Finish from the current offsets.
+    if copied < size:
+        Log.trace(f"Falling back to a buffered copy after {copied} of {size} bytes")
+        shutil.copyfileobj(fsrc, fdst, 4 * 1024 * 1024)
+
+    # Neither copy is going to be read again soon, so don't let them crowd out the page cache
+    fdst.flush()
+    fadvise(fsrc.fileno(), "POSIX_FADV_DONTNEED")
+    fadvise(fdst.fileno(), "POSIX_FADV_DONTNEED")
+
+@Log.traced
+def copy_file_data(src: str, dst: str):
+    with open(src, "rb") as fsrc, open(dst, "xb") as fdst:
+        if reflink(fsrc, fdst):
+            Log.info("Reflinked instead of copying")
+        else:
+            stream_copy(fsrc, fdst)
+    shutil.copystat(src, dst)
+
 @Log.traced
 def copy_file(src: str, dst: str):
     if path.exists(dst):
         Log.error(f"Refusing to overwrite '{src}' with '{dst}'")
 
-    test_file = pathlib.Path(dst)
-    test_file.touch()
-    can_link = files_on_same_fs(src, dst)
-    test_file.unlink()
+    # The destination is on the same filesystem as the directory it will be created in
+    can_link = files_on_same_fs(src, path.dirname(dst) or ".")
 
     if can_link:
         Log.info(f"Hardlinking '{src}' to '{dst}'")
         os.link(src, dst)
     else:
         Log.info(f"Copying '{src}' to '{dst}'")
-        shutil.copy2(src, dst)
+        copy_file_data(src, dst)
 
 class BadEncodingDatabase:
     def __init__(self):
@@ -175,6 +318,10 @@ class BadEncodingDatabase:
 
     @Log.traced
     def init_db(self):
+        # WAL with synchronous=NORMAL only fsyncs on checkpoints, not on every commit
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("PRAGMA temp_store=MEMORY")
         self.db.execute("""
             CREATE TABLE IF NOT EXISTS bad_encodings(
                 hash BLOB,
@@ -184,37 +331,103 @@ class BadEncodingDatabase:
                 PRIMARY KEY (hash, crf, preset)
             )
         """)
+        # Results from hardware encoders, whose crf/preset mean something different
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS bad_encodings_hw(
+                hash BLOB,
+                encoder TEXT,
+                crf INT,
+                preset TEXT,
+                output_bytes INT,
+                PRIMARY KEY (hash, encoder, crf, preset)
+            )
+        """)
+        # Caches hashes by path and stat info so unchanged files aren't rehashed
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS bad_encodings_stat(
+                path TEXT PRIMARY KEY,
+                mtime_ns INT,
+                size INT,
+                hash BLOB
+            )
+        """)
         self.db.commit()
 
     @Log.traced
-    def check(self, path: str, crf: int, preset: str):
-        file_hash = BadEncodingDatabase.hash_file(path)
-        params = (file_hash, crf, preset)
+    def file_hash(self, f: str):
+        st = os.stat(f)
+        key = (path.abspath(f), st.st_mtime_ns, st.st_size)
         cursor = self.db.execute("""
-            SELECT output_bytes FROM bad_encodings WHERE hash == ? AND crf == ? AND preset == ?
-        """, params)
+            SELECT hash FROM bad_encodings_stat WHERE path == ? AND mtime_ns == ? AND size == ?
+        """, key)
+        res = cursor.fetchone()
+        cursor.close()
+        if res is not None:
+            return res[0]
+
+        file_hash = BadEncodingDatabase.hash_file(f)
+        self.db.execute("""
+            INSERT OR REPLACE INTO bad_encodings_stat (path, mtime_ns, size, hash) VALUES (?, ?, ?, ?)
+        """, key + (file_hash,))
+        # Don't hold the write lock across the encode, other processes need the database too
+        self.db.commit()
+        return file_hash
+
+    @Log.traced
+    def check(self, path: str, crf: int, preset: str, encoder: str):
+        file_hash = self.file_hash(path)
+        if encoder in Encoders.HARDWARE:
+            cursor = self.db.execute("""
+                SELECT output_bytes FROM bad_encodings_hw WHERE hash == ? AND encoder == ? AND crf == ? AND preset == ?
+            """, (file_hash, encoder, crf, preset))
+        else:
+            cursor = self.db.execute("""
+                SELECT output_bytes FROM bad_encodings WHERE hash == ? AND crf == ? AND preset == ?
+            """, (file_hash, crf, preset))
         res = cursor.fetchone()
         cursor.close()
         if res is not None: res = res[0]
         return res
 
     @Log.traced
-    def insert(self, f: str, crf: int, preset: str, output_bytes: int):
-        params = (BadEncodingDatabase.hash_file(f), crf, preset, output_bytes)
-        cursor = self.db.execute("""
-            INSERT INTO bad_encodings (hash, crf, preset, output_bytes) VALUES (?, ?, ?, ?)
-        """, params)
+    def insert(self, f: str, crf: int, preset: str, encoder: str, output_bytes: int):
+        file_hash = self.file_hash(f)
+        if encoder in Encoders.HARDWARE:
+            cursor = self.db.execute("""
+                INSERT INTO bad_encodings_hw (hash, encoder, crf, preset, output_bytes) VALUES (?, ?, ?, ?, ?)
+            """, (file_hash, encoder, crf, preset, output_bytes))
+        else:
+            cursor = self.db.execute("""
+                INSERT INTO bad_encodings (hash, crf, preset, output_bytes) VALUES (?, ?, ?, ?)
+            """, (file_hash, crf, preset, output_bytes))
         self.db.commit()
         cursor.close()
 
-    @functools.cache
+    # Files at least this big are hashed through an mmap in a single update() call
+    HASH_MMAP_THRESHOLD = 10 * 1024 * 1024
+
+    # The hash is only used as a database key, so it doesn't need to be SHA-1
+    def new_hasher():
+        return hashlib.blake2b(digest_size=20)
+
     @Log.traced
     def hash_file(p: str):
         Log.info("Hashing input file")
-        hasher = hashlib.sha1()
-        with open(p, "rb") as f:
-            while buf := f.read(1024 * 1024):
-                hasher.update(buf)
+        hasher = BadEncodingDatabase.new_hasher()
+        # Unbuffered, since reads go straight into our own buffer
+        with open(p, "rb", buffering=0) as f:
+            fadvise(f.fileno(), "POSIX_FADV_SEQUENTIAL")
+            if os.fstat(f.fileno()).st_size >= BadEncodingDatabase.HASH_MMAP_THRESHOLD:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    if hasattr(mmap, "MADV_SEQUENTIAL"):
+                        mm.madvise(mmap.MADV_SEQUENTIAL)
+                    hasher.update(mm)
+            else:
+                # Reuse one buffer instead of allocating a new bytes object per read
+                buf = bytearray(4 * 1024 * 1024)
+                view = memoryview(buf)
+                while n := f.readinto(buf):
+                    hasher.update(view[:n])
         return hasher.digest()
 
 # Non-blocking file lock
@@ -236,7 +449,7 @@ class NBFlock:
 
 # The big one
 @Log.traced
-def reencode(in_file: str, out_file: str, crf: int, preset: str, force: bool, extra_args: list[str] = [], dont_copy: bool = False, out_width: Optional[int] = None):
+def reencode(in_file: str, out_file: str, crf: int, preset: str, force: bool, extra_args: list[str] = [], dont_copy: bool = False, out_width: Optional[int] = None, threads: Optional[int] = None, lock: bool = True, gpu: bool = True):
     out_file = as_mp4(out_file)
 
     Log.info("input  =", "'" + in_file + "'")
@@ -245,30 +458,40 @@ def reencode(in_file: str, out_file: str, crf: int, preset: str, force: bool, ex
     Log.check(not path.islink(in_file), "Refusing symlink")
     Log.check(not path.basename(in_file).startswith("."), "Refusing dotfile")
     Log.check(not path.exists(out_file), "Output file already exists")
-    Log.check(Probe.isvideo(in_file), "Not a compatible file")
-    codec = Probe.codec(in_file)
-    acodec = Probe.acodec(in_file)
-    encoder = (codec == "hevc") and "copy" or "libx265"
+    try:
+        (codec, acodec, _) = Probe.probe(in_file)
+    except Log.ErrorCalled:
+        Log.error("Not a compatible file")
+    encoder = (codec == "hevc") and "copy" or (gpu and Encoders.hardware()) or "libx265"
     aencoder = (acodec == "aac" or acodec is None) and "copy" or "aac"
     scale_args = out_width and ["-vf", f"scale=-1:'min(iw,{out_width})'"] or []
+    thread_args = threads and ["-threads", str(threads)] or []
 
     if not force and encoder == "copy" and aencoder == "copy" and out_width == None:
         Log.warn("Input file is already encoded as hevc/aac")
         if dont_copy:
             return None
-        else:
+        elif in_file.lower().endswith("mp4"):
+            # Nothing to do, so link or reflink the original instead of remuxing it
             copy_file(in_file, out_file)
+        else:
+            # Only the container has to change
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                temp_out_file = path.join(tmp_dir, path.basename(out_file))
+                ffmpeg(["-i", in_file, "-c:v", "copy", "-c:a", "copy", temp_out_file])
+                copy_file(temp_out_file, out_file)
     else:
-        in_size = humansize.humansize_file(in_file)
+        in_bytes = file_size(in_file)
+        in_size = humansize.humansize(in_bytes)
 
         with (
-            NBFlock(in_file), 
+            NBFlock(in_file) if lock else contextlib.nullcontext(),
             BadEncodingDatabase() as db, 
             tempfile.TemporaryDirectory() as tmp_dir
         ):
             Log.trace("tmp_dir =", tmp_dir)
 
-            if not force and (prev_result := db.check(in_file, crf, preset)):
+            if not force and (prev_result := db.check(in_file, crf, preset, encoder)):
                 out_size = humansize.humansize(prev_result)
                 Log.warn(f"File in bad encodings database (increases {in_size} -> {out_size})")
                 if dont_copy:
@@ -278,27 +501,23 @@ def reencode(in_file: str, out_file: str, crf: int, preset: str, force: bool, ex
                     return out_file
 
             temp_out_file = path.join(tmp_dir, path.basename(out_file))
-            ffmpeg(
-                extra_args
-                + [
-                    "-i", in_file,
-                    "-c:a", aencoder,
-                    "-c:v", encoder,
-                    "-crf", str(crf),
-                    "-preset", preset,
-                    "-x265-params", "log-level=error"
-                ]
-                + scale_args
-                + [ temp_out_file ]
-            )
-
-            percent = file_size_percent(temp_out_file, in_file)
-            out_size = humansize.humansize_file(temp_out_file)
+            ffmpeg([
+                *extra_args,
+                "-i", in_file,
+                "-c:a", aencoder,
+                *Encoders.args(encoder, crf, preset, threads),
+                *scale_args,
+                *thread_args,
+                temp_out_file
+            ])
+
+            out_bytes = file_size(temp_out_file)
+            percent = size_percent(out_bytes, in_bytes)
+            out_size = humansize.humansize(out_bytes)
             Log.info(f"Output is {percent}% the original size ({in_size} -> {out_size})")
 
             if not force and percent >= 100:
-                out_bytes = file_size(temp_out_file)
-                db.insert(in_file, crf, preset, out_bytes)
+                db.insert(in_file, crf, preset, encoder, out_bytes)
                 copy_file(in_file, out_file)
                 Log.error("File size increased!")
 
@@ -313,8 +532,18 @@ BENCHMARKS = [
     (23, "fast")
 ]
 BENCHMARK_DURATION = 60 # seconds
+
+@Log.traced
+def benchmark_one(in_file: str, sample_bytes: int, out_dir: str, crf: int, preset: str, extra_args: list[str], threads: int, gpu: bool):
+    out_file = path.join(out_dir, f"{preset}-{crf}.mp4")
+    start = time.time()
+    reencode(in_file, out_file, crf, preset, True, extra_args=extra_args, threads=threads, lock=False, gpu=gpu)
+    reencode_time = round(time.time() - start)
+    percent = size_percent(file_size(out_file), sample_bytes)
+    return f"{out_file}\t{reencode_time}s\t{percent}%"
+
 @Log.traced
-def benchmark(in_file: str, out_dir: str):
+def benchmark(in_file: str, out_dir: str, gpu: bool = True):
     # If possible, grab 1 minute in the middle of the original
     # Otherwise do the whole video
     dur = Probe.duration(in_file)
@@ -333,15 +562,20 @@ def benchmark(in_file: str, out_dir: str):
         sample
     ])
 
-    # Do benchmarks
-    reports = []
-    for (crf, preset) in BENCHMARKS:
-        out_file = path.join(out_dir, f"{preset}-{crf}.mp4")
-        start = time.time()
-        reencode(in_file, out_file, crf, preset, True, extra_args=extra_args)
-        reencode_time = round(time.time() - start)
-        percent = file_size_percent(out_file, sample)
-        reports.append(f"{out_file}\t{reencode_time}s\t{percent}%")
+    sample_bytes = file_size(sample)
+
+    # Do benchmarks in parallel, splitting the cores between them.
+    # Threads are enough since each job just waits on ffmpeg.
+    # Hardware encoders run one at a time, they limit concurrent sessions.
+    cpus = os.cpu_count() or 1
+    jobs = (gpu and Encoders.hardware()) and 1 or min(len(BENCHMARKS), cpus)
+    threads = max(1, cpus // jobs)
+    with NBFlock(in_file), concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            executor.submit(benchmark_one, in_file, sample_bytes, out_dir, crf, preset, extra_args, threads, gpu)
+            for (crf, preset) in BENCHMARKS
+        ]
+        reports = [f.result() for f in futures]
 
     # Write reports
     report = path.join(out_dir, "report")
@@ -356,7 +590,7 @@ def backup(f: str):
     shutil.move(f, f + ".reenc_backup")
 
 def is_backup(f: str):
-    f.endswith(".reenc_backup")
+    return f.endswith(".reenc_backup")
 
 @dataclass
 class RunArgs:
@@ -372,6 +606,7 @@ class RunArgs:
     replace: bool
     benchmark: bool
     width: Optional[int]
+    nogpu: bool
 
 @Log.traced
 def reencode_replace(ra: RunArgs):
@@ -383,7 +618,7 @@ def reencode_replace(ra: RunArgs):
         if dest != ra.in_file and path.exists(dest):
             Log.error(f"Replacing '{ra.in_file}' would overwrite a different file: '{dest}'")
 
-        if out_file := reencode(ra.in_file, initial_out_file, ra.crf, ra.preset, ra.force, dont_copy=True, out_width = ra.width):
+        if out_file := reencode(ra.in_file, initial_out_file, ra.crf, ra.preset, ra.force, dont_copy=True, out_width = ra.width, gpu = not ra.nogpu):
             if ra.nobackup:
                 os.remove(ra.in_file)
             else:
@@ -398,14 +633,15 @@ def print_probe(f: str):
     sec = round(dur % 60, 2)
     size = humansize.humansize_file(f)
     codec = Probe.codec(f)
-    print(size, codec, f"{min}:{sec:02}", f, sep=", ")
+    # A single write, so lines from parallel jobs don't interleave
+    print(", ".join([size, codec, f"{min}:{sec:02}", f]), flush=True)
 
+# A tuple so skip_file can check them all with a single endswith() call
+SKIP_EXTS = ("jpg", "png", "jpeg", "posts", "yml", "info", "sh", "pdf", "swf", "xml", "mp3", "css", "url",
+             "txt", "html", "exe", "py", "dv", "heic", "db", "zip", "psd", "pyc", "pem", "jpe", "typed", "readme",
+             "md", "rar")
 def skip_file(f: str):
-    SKIP_EXTS = {"jpg", "png", "jpeg", "posts", "yml", "info", "sh", "pdf", "swf", "xml", "mp3", "css", "url",
-                 "txt", "html", "exe", "py", "dv", "heic", "db", "zip", "psd", "pyc", "pem", "jpe", "typed", "readme",
-                 "md", "rar"}
-    has_skip_ext = any(map(lambda ext, s=f: s.lower().endswith(ext), SKIP_EXTS))
-    return is_backup(f) or has_skip_ext
+    return is_backup(f) or f.lower().endswith(SKIP_EXTS)
 
 def main_run(ra: RunArgs):
     Log.tracing = ra.trace
@@ -415,12 +651,12 @@ def main_run(ra: RunArgs):
     elif ra.probe:
         print_probe(ra.in_file)
     elif ra.benchmark:
-        benchmark(ra.in_file, ra.outdir)
+        benchmark(ra.in_file, ra.outdir, gpu = not ra.nogpu)
     elif ra.replace:
         reencode_replace(ra)
     else:
         out_file = path.join(ra.outdir, path.basename(ra.in_file))
-        out_file = reencode(ra.in_file, out_file, ra.crf, ra.preset, ra.force, out_width = ra.width)
+        out_file = reencode(ra.in_file, out_file, ra.crf, ra.preset, ra.force, out_width = ra.width, gpu = not ra.nogpu)
 
         if ra.replacelink:
             if ra.nobackup:
@@ -430,13 +666,30 @@ def main_run(ra: RunArgs):
             target = path.relpath(out_file, path.dirname(ra.in_file))
             os.symlink(target, ra.in_file)
 
+# An error in one file shouldn't stop the remaining files.
+# Returns False if the file hit an unexpected error.
+def main_run_one(ra: RunArgs):
+    try:
+        main_run(ra)
+    except (subprocess.CalledProcessError, Log.ErrorCalled):
+        # Already logged
+        pass
+    except Exception:
+        Log.error(f"Unexpected error while processing '{ra.in_file}'", exception=False)
+        traceback.print_exc()
+        return False
+    return True
+
+# Returns False if any file hit an unexpected error
 def main():
     PRESETS = ["ultrafast", "superfast", "veryfast", "faster", "fast", "medium", "slow", "slower", "veryslow"]
 
     parser = argparse.ArgumentParser(description="ffmpeg wrapper", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument("INPUT", help="Input video file")
-    parser.add_argument("--preset", help="libx265 preset", default="fast", choices=PRESETS)
-    parser.add_argument("--crf", help="libx265 CRF value, 0-51", type=int, default=23)
+    parser.add_argument("INPUT", help="Input video file(s)", nargs="*")
+    parser.add_argument("--stdin", help="Also read input files from stdin, one per line", action="store_true")
+    parser.add_argument("--jobs", help="Number of files to process in parallel", type=int, default=1)
+    parser.add_argument("--preset", help="libx265 preset, mapped to the closest hardware encoder preset unless --nogpu is given", default="fast", choices=PRESETS)
+    parser.add_argument("--crf", help="libx265 CRF value, 0-51, passed as -cq (NVENC) or -global_quality (QSV) to a hardware encoder unless --nogpu is given", type=int, default=23)
     parser.add_argument("--force", help="Reencode videos even if they are already encoded as HEVC", action='store_true')
     parser.add_argument("--replacelink", help="Replace input file with a symlink to the output file", action="store_true")
     parser.add_argument("--nobackup", help="Disable backing up original files when using --replace", action="store_true")
@@ -444,18 +697,47 @@ def main():
     parser.add_argument("--outdir", help="Output reencoded video into the given directory, with an inferred name", default="./")
     parser.add_argument("--trace", help="Enable tracing logs", action="store_true")
     parser.add_argument("--width", help="Scale the output to have the given width", type=int)
+    parser.add_argument("--nogpu", help="Always encode with libx265, even if a hardware HEVC encoder is available", action="store_true")
     output_args = parser.add_mutually_exclusive_group()
     output_args.add_argument("--replace", help="Replace the input file after encoding", action="store_true")
     output_args.add_argument("--benchmark", help="Run benchmarks", action="store_true")
     args = parser.parse_args()
 
-    ra = RunArgs(args.INPUT, args.crf, args.preset, args.force, args.replacelink, args.nobackup, args.probe, args.outdir, args.trace, args.replace, args.benchmark, args.width)
-    main_run(ra)
+    Log.tracing = args.trace
+
+    files = args.INPUT
+    if args.stdin:
+        files = files + [line.rstrip("\n") for line in sys.stdin if line.strip()]
+    if len(files) == 0:
+        parser.error("no input files")
+    if args.probe and len(files) > 1:
+        # Files that fail to probe have already been logged, so drop them
+        probed = Probe.probe_many([f for f in files if not skip_file(f)])
+        files = [f for f in files if skip_file(f) or f in probed]
+
+    run_args = [
+        RunArgs(f, args.crf, args.preset, args.force, args.replacelink, args.nobackup, args.probe, args.outdir, args.trace, args.replace, args.benchmark, args.width, args.nogpu)
+        for f in files
+    ]
+
+    if args.jobs > 1:
+        # Fill the encoder cache first so workers don't each detect it again
+        if not args.nogpu and not args.probe:
+            Encoders.hardware()
+
+        # Forked workers inherit the probe and encoder caches filled so far
+        ctx = multiprocessing.get_context("fork")
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs, mp_context=ctx, initializer=Log.update_pidtag) as executor:
+            results = list(executor.map(main_run_one, run_args))
+    else:
+        results = [main_run_one(ra) for ra in run_args]
+    return all(results)
 
 if __name__ == "__main__":
     exitcode = 0
     try:
-        main()
+        if not main():
+            exitcode = 1
     except (subprocess.CalledProcessError, Log.ErrorCalled):
         exitcode = 0
     except KeyboardInterrupt:
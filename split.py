@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
-import sys, os, stat, argparse
+import sys, os, stat, argparse, operator
+from concurrent.futures import ThreadPoolExecutor
 from humansize import humansize
 
 parser = argparse.ArgumentParser()
@@ -19,28 +20,29 @@ assert index >= 0, "Index must not be less than zero"
 files = []
 skipped_any = False
 # for basename in os.listdir(dirname):
-for path in sys.stdin:
-    # path = os.path.join(dirname, basename)
-    path = path.strip()
-    meta = os.lstat(path)
-    if stat.S_ISREG(meta.st_mode):
-        files.append((path, meta.st_size))
-    else:
-        if not skipped_any:
-            skipped_any = True
-            sys.stderr.write(f"Skipping non-regular files: {path}")
+paths = [path.strip() for path in sys.stdin]
+# paths = [os.path.join(dirname, basename) for basename in os.listdir(dirname)]
+
+# Stat on a thread pool so cold-cache lookups overlap instead of running one at a time
+with ThreadPoolExecutor(max_workers=32) as executor:
+    metas = executor.map(os.lstat, paths)
+    for path, meta in zip(paths, metas):
+        if stat.S_ISREG(meta.st_mode):
+            files.append((path, meta.st_size))
         else:
-            sys.stderr.write(f", {path}")
+            if not skipped_any:
+                skipped_any = True
+                sys.stderr.write(f"Skipping non-regular files: {path}")
+            else:
+                sys.stderr.write(f", {path}")
 if skipped_any:
     sys.stderr.write("\n")
 
-files.sort(key=lambda p: p[1])
-files.reverse()
+files.sort(key=operator.itemgetter(1), reverse=True)
 
-total_size = 0
-for i in range(index, len(files), divisor):
-    (path, size) = files[i]
-    total_size += size
+group = files[index::divisor]
+total_size = sum(map(operator.itemgetter(1), group))
+for (path, _) in group:
     print(path)
 
 sys.stderr.write(f"Total size: {humansize(total_size)}\n")